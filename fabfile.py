@@ -1,44 +1,335 @@
+import atexit
+import hashlib
+import io
 import json
 import os
+import re
+import shlex
 import textwrap
+import time
+import urllib.error
 import urllib.request
-from functools import total_ordering
-from itertools import zip_longest
+from collections import defaultdict
+from functools import lru_cache, total_ordering
 from typing import Self
 
 from fabric import Connection, task
-from patchwork.files import append, contains, exists
+from invoke import Result, UnexpectedExit
+
+# print the commands instead of running them
+DRY_RUN = bool(os.environ.get('SETUP_SERVER_DRY_RUN'))
+CACHE_DIR = os.path.expanduser('~/.cache/setup-server')
+# mirror of https://nodejs.org/dist/index.json
+NODE_INDEX_URL = 'https://registry.npmmirror.com/-/binary/node/index.json'
+NODE_LISTING_URL = 'https://nodejs.org/download/release/latest-{}/'
+SYSCTL_CONF = '/etc/sysctl.d/99-setup-server.conf'
+# written by debian() once done, holds the hash of the config below
+STATE_FILE = '/etc/setup-server.state'
+# readable by any user, unlike sysctl which is not on a non-root PATH
+CONGESTION = '/proc/sys/net/ipv4/tcp_available_congestion_control'
+# apt-get update, unless the package lists are younger than an hour
+APT_UPDATE = (
+    'test -n "$(find /var/lib/apt/lists -maxdepth 0 -mmin -60)" || apt-get update -yq'
+)
+DEBIAN_PACKAGES = (
+    'git unzip curl wget tar sudo zip '
+    'sqlite3 tmux ntp build-essential gettext libcap2-bin netcat-traditional '
+    'silversearcher-ag htop jq dirmngr cron rsync locales net-tools'
+).split()
+PYTHON_BUILD_PACKAGES = (
+    'build-essential checkinstall libncursesw5-dev libssl-dev '
+    'libsqlite3-dev tk-dev libgdbm-dev libc6-dev libbz2-dev libffi-dev '
+    'libreadline-dev liblzma-dev zlib1g-dev'
+).split()
+# limits.conf, max open files
+LIMITS = [
+    '*    soft    nofile  500000',
+    '*    hard    nofile  500000',
+    'root soft    nofile  500000',
+    'root hard    nofile  500000',
+]
+SYSCTL = {
+    'vm.overcommit_memory': '1',
+    'net.core.somaxconn': '65535',
+    'fs.file-max': '6553560',
+    # disable ipv6
+    'net.ipv6.conf.all.disable_ipv6': '1',
+    'net.ipv6.conf.default.disable_ipv6': '1',
+    'net.ipv6.conf.lo.disable_ipv6': '1',
+}
+# host -> facts, see _facts()
+_FACTS: dict[str, dict[str, str]] = {}
 
 
 @total_ordering
 class Version:
     def __init__(self, ver: str):
         self.value = ver
-        self.ver1, self.ver2 = self.normalize(ver)
+        self.ver1, self.ver2 = Version.normalize(ver)
+        # compared as plain tuples, numbers sort before strings in the suffix.
+        # trailing zeros and an empty suffix don't count: 4.9 == 4.9.0 < 4.9.0-1
+        ver1 = list(self.ver1)
+        while ver1 and ver1[-1] == 0:
+            ver1.pop()
+        self._key = (
+            tuple(ver1),
+            tuple(
+                (0, i) if isinstance(i, int) else (1, i) for i in self.ver2 if i != ''
+            ),
+        )
 
-    def normalize(self, ver: str) -> tuple[list[int], list[int | str]]:
-        y = ver.split('-', 1)
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def normalize(ver: str) -> tuple[tuple[int, ...], tuple[int | str, ...]]:
+        # node versions come as v20.1.0
+        y = ver.removeprefix('v').split('-', 1)
         if len(y) == 2:
             y1, y2 = y
         else:
             y1, y2 = y[0], ''
-        return [int(i or 0) for i in y1.split('.')], [
+        return tuple(int(i or 0) for i in y1.split('.')), tuple(
             int(i) if i.isdigit() else i for i in y2.split('-')
-        ]
+        )
 
     def __eq__(self, other: Self) -> bool:
-        return self.value == other.value
+        return self._key == other._key
 
     def __lt__(self, other: Self) -> bool:
-        for i, j in zip_longest(self.ver1, other.ver1, fillvalue=0):
-            if i != j:
-                return i < j
-        for i, j in zip_longest(self.ver2, other.ver2, fillvalue=0):
-            if type(i) is not type(j):
-                i, j = str(i), str(j)
-            if i != j:
-                return i < j
+        return self._key < other._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+
+def _ensure_open(c: type[Connection]):
+    """
+    Open the SSH transport once, so every later command of every task is just a
+    new channel on it instead of a new TCP connection and key exchange
+    """
+    if not DRY_RUN and not c.is_connected:
+        c.open()
+        # survive NAT timeouts during long silent steps like apt upgrade
+        c.transport.set_keepalive(30)
+        atexit.register(c.close)
+
+
+def _run(c: type[Connection], cmd: str, sudo: bool = False, **kwargs) -> Result:
+    """
+    c.run/c.sudo, or only print the command in a dry run. Probes (warn=True)
+    fail in a dry run, so it shows what a fresh host would get
+    """
+    if DRY_RUN:
+        stdin = kwargs['in_stream'].getvalue() if 'in_stream' in kwargs else ''
+        print(f'[{"sudo" if sudo else "run"}] {cmd}\n{stdin}'.rstrip())
+        return Result(command=cmd, exited=1 if kwargs.get('warn') else 0)
+    return (c.sudo if sudo else c.run)(cmd, **kwargs)
+
+
+def _sudo(c: type[Connection], cmd: str, **kwargs) -> Result:
+    return _run(c, cmd, sudo=True, **kwargs)
+
+
+def _put(c: type[Connection], local: str | io.StringIO, remote: str):
+    if DRY_RUN:
+        if isinstance(local, io.StringIO):
+            print(f'[put] {remote}\n{local.getvalue()}'.rstrip())
+        else:
+            print(f'[put] {local} -> {remote}')
+        return
+    c.put(local, remote)
+
+
+def _exists(c: type[Connection], path: str) -> bool:
+    return _run(c, f'test -e {path}', warn=True).ok
+
+
+def _script(c: type[Connection], script: str, sudo: bool = True, **kwargs):
+    """
+    Run a multi-line shell script as root over a single channel
+    """
+    script = f'set -e\n{script}'
+    cmd = 'sudo bash -s' if sudo else 'bash -s'
+    return _run(c, cmd, in_stream=io.StringIO(script), **kwargs)
+
+
+def _facts(c: type[Connection]) -> dict[str, str]:
+    """
+    Probe the host in one round trip, cached per host for the whole run
+    """
+    if DRY_RUN:
+        # a dry run pictures a fresh, up to date debian host with sudo
+        return _FACTS.setdefault(
+            c.original_host,
+            defaultdict(
+                str,
+                kernel='6.1.0-18-amd64',
+                codename='bookworm',
+                uid='1000',
+                sudo='/usr/bin/sudo',
+            ),
+        )
+    if c.original_host not in _FACTS:
+        output = _get_output(
+            c,
+            textwrap.dedent(
+                f"""
+                echo kernel=$(uname -r)
+                echo codename=$(. /etc/os-release && echo $VERSION_CODENAME)
+                echo uid=$(id -u)
+                echo sudo=$(command -v sudo)
+                echo docker=$(command -v docker)
+                echo node=$(command -v node > /dev/null && node --version)
+                echo congestion=$(cat {CONGESTION})
+                echo pyenv=$(test -d ~/.pyenv && echo 1)
+                echo poetry=$(test -x ~/.local/bin/poetry && echo 1)
+                echo state=$(cat {STATE_FILE} 2>/dev/null)
+                """
+            ),
+        )
+        # unknown facts read as empty
+        _FACTS[c.original_host] = defaultdict(
+            str, (line.split('=', 1) for line in output.splitlines() if '=' in line)
+        )
+    return _FACTS[c.original_host]
+
+
+def _missing_lines(c: type[Connection], path: str, lines: list[str]) -> list[str]:
+    """
+    Lines not present in a remote file, checked by a single grep on the host
+    instead of transferring the file
+    """
+    result = _run(
+        c,
+        # grep's 1 (nothing missing) becomes 0, so a 1 can only be sudo failing
+        f"sudo sh -c 'grep -Fxvf {path} -; rc=$?; [ $rc -le 1 ] || exit $rc'",
+        in_stream=io.StringIO(''.join(f'{i}\n' for i in lines)),
+        hide=True,
+        warn=True,
+    )
+    # 2: no such file
+    if DRY_RUN or result.return_code == 2:
+        return lines
+    if result.return_code:
+        raise UnexpectedExit(result)
+    return result.stdout.splitlines()
+
+
+def _apt_install_sh(packages: list[str]) -> str:
+    """
+    Shell fragment installing the packages that are missing, the package lists
+    are only refreshed if there is something to install
+    """
+    return textwrap.dedent(
+        f"""
+        missing=$(dpkg-query -W -f='${{db:Status-Abbrev}} ${{Package}}\\n' \\
+            | awk '$1 == "ii" {{print $2}}' \\
+            | grep -Fxvf - <(printf '%s\\n' {' '.join(packages)}) || true)
+        if [ -n "$missing" ]; then
+            {APT_UPDATE}
+            apt-get install -yq $missing
+        fi
+        """
+    )
+
+
+def _sysctl_sh(kv: dict[str, str]) -> str:
+    """
+    Shell fragment setting kernel parameters in our sysctl drop-in, replacing
+    older values of the same keys, and loading them if anything changed
+    """
+    lines = ' '.join(shlex.quote(f'{k} = {v}') for k, v in kv.items())
+    return textwrap.dedent(
+        f"""
+        changed=
+        touch {SYSCTL_CONF}
+        for line in {lines}; do
+            grep -qxF "$line" {SYSCTL_CONF} && continue
+            sed -i "/^${{line%% *}} *=/d" {SYSCTL_CONF}
+            echo "$line" >> {SYSCTL_CONF}
+            changed=1
+        done
+        if [ -n "$changed" ]; then
+            sysctl --system > /dev/null
+        fi
+        """
+    )
+
+
+def _ensure_lines(c: type[Connection], path: str, lines: list[str]) -> bool:
+    """
+    Append lines missing from a remote file, in one read and one write.
+    Returns True if the file was changed
+    """
+    missing = _missing_lines(c, path, lines)
+    if not missing:
         return False
+    _run(
+        c,
+        f"printf '%s\\n' {' '.join(map(shlex.quote, missing))} "
+        f'| sudo tee -a {path} > /dev/null',
+    )
+    return True
+
+
+def _apply_sysctl(c: type[Connection], kv: dict[str, str]):
+    """
+    Set kernel parameters in our sysctl drop-in and load them
+    """
+    if kv:
+        _script(c, _sysctl_sh(kv))
+
+
+def _debian_sh(sysctl: dict[str, str]) -> list[str]:
+    """
+    The debian setup as one script, run over one channel
+    """
+    return [
+        'export DEBIAN_FRONTEND=noninteractive',
+        # apt-get
+        APT_UPDATE,
+        'apt-get -yq -o Dpkg::Options::="--force-confdef" '
+        '-o Dpkg::Options::="--force-confold" upgrade',
+        _apt_install_sh(DEBIAN_PACKAGES),
+        # add-apt-repository
+        'dpkg -s software-properties-common > /dev/null 2>&1 '
+        '|| apt-get install -yq software-properties-common || true',
+        # systemctl enable ntp.service
+        # systemctl start ntp.service
+        # locale, in the background while the rest goes on
+        'echo en_US.UTF-8 UTF-8 > /etc/locale.gen',
+        'locale-gen en_US.UTF-8 > /dev/null & locale_gen=$!',
+        # UTC timezone
+        'cp /usr/share/zoneinfo/UTC /etc/localtime || true',
+        # limits.conf, max open files
+        f"printf '%s\\n' {' '.join(map(shlex.quote, LIMITS))} "
+        '> /etc/security/limits.conf',
+        # https://underyx.me/2015/05/18/raising-the-maximum-number-of-file-descriptors
+        textwrap.dedent(
+            """
+            for p in /etc/pam.d/common-session /etc/pam.d/common-session-noninteractive
+            do
+                if [ -f $p ] && ! grep -qxF 'session required pam_limits.so' $p; then
+                    echo 'session required pam_limits.so' >> $p
+                fi
+            done
+            """
+        ),
+        # "systemd garbage"
+        textwrap.dedent(
+            """
+            if [ -f /etc/systemd/system.conf ]; then
+                sed -i "s/^#DefaultLimitNOFILE=.*/DefaultLimitNOFILE=500000/g" \\
+                    /etc/systemd/system.conf || true
+            fi
+            """
+        ),
+        # disable ubuntu upgrade check
+        "sed -i 's/^Prompt.*/Prompt=never/' "
+        '/etc/update-manager/release-upgrades 2>/dev/null || true',
+        # sysctl, bbr
+        _sysctl_sh(sysctl),
+        'wait $locale_gen',
+    ]
 
 
 @task
@@ -46,77 +337,19 @@ def debian(c: type[Connection]):
     """
     Setup a debian server
     """
-    # sudo
-    if not c.run('which sudo', warn=True).ok:
-        c.run('apt-get install sudo -y')
-    # apt-get
-    c.sudo('apt-get update -yq')
-    c.sudo(
-        'DEBIAN_FRONTEND=noninteractive '
-        'apt-get -yq -o Dpkg::Options::="--force-confdef" '
-        '-o Dpkg::Options::="--force-confold" upgrade'
-    )
-    c.sudo(
-        'apt-get install -yq git unzip curl wget tar sudo zip '
-        'sqlite3 tmux ntp build-essential gettext libcap2-bin netcat-traditional '
-        'silversearcher-ag htop jq dirmngr cron rsync locales net-tools'
-    )
-    # add-apt-repository
-    c.sudo('apt-get install -yq software-properties-common', warn=True)
-    # c.sudo('systemctl enable ntp.service')
-    # c.sudo('systemctl start ntp.service')
-    # dotfiles
+    _ensure_open(c)
+    # already set up with this very script? bbr depends on the host, so is left out
+    state = hashlib.sha256('\n'.join(_debian_sh(SYSCTL)).encode()).hexdigest()
+    if _facts(c)['state'] == state:
+        print('Already set up')
+        # the marker is host-wide, dotfiles are per user
+        dotfiles(c)
+        return
+    script = _debian_sh(SYSCTL | _bbr_sysctl(c)) + [f'echo {state} > {STATE_FILE}']
+    # without sudo we have to be root already
+    _script(c, '\n'.join(script), sudo=bool(_facts(c)['sudo']))
     dotfiles(c)
-    # UTC timezone
-    c.sudo('cp /usr/share/zoneinfo/UTC /etc/localtime', warn=True)
-    # limits.conf, max open files
-    c.run(
-        r'echo -e "*    soft    nofile  500000\n*    hard    nofile  500000'
-        r'\nroot soft    nofile  500000\nroot hard    nofile  500000"'
-        r' | sudo tee /etc/security/limits.conf'
-    )
-    # https://underyx.me/2015/05/18/raising-the-maximum-number-of-file-descriptors
-    line = 'session required pam_limits.so'
-    for p in ('/etc/pam.d/common-session', '/etc/pam.d/common-session-noninteractive'):
-        if exists(c, p) and not contains(c, p, line):
-            append(c, p, line)
-    # "systemd garbage"
-    systemd_conf = '/etc/systemd/system.conf'
-    if exists(c, systemd_conf):
-        c.sudo(
-            'sed -i '
-            f'"s/^#DefaultLimitNOFILE=.*/DefaultLimitNOFILE=500000/g" {systemd_conf}',
-            warn=True,
-        )
-    # sysctl.conf
-    path = '/etc/sysctl.conf'
-    for line in (
-        'vm.overcommit_memory = 1',
-        'net.core.somaxconn = 65535',
-        'fs.file-max = 6553560',
-    ):
-        if not contains(c, path, line):
-            append(c, path, line)
-    c.sudo('sysctl -p')
-    # disable ubuntu upgrade check
-    c.sudo(
-        "sed -i 's/^Prompt.*/Prompt=never/' /etc/update-manager/release-upgrades",
-        warn=True,
-    )
-    # locale
-    c.run('echo en_US.UTF-8 UTF-8 | sudo tee /etc/locale.gen')
-    c.sudo('locale-gen en_US.UTF-8')
-    # bbr
-    bbr(c)
-    # disable ipv6
-    for line in [
-        'net.ipv6.conf.all.disable_ipv6 = 1',
-        'net.ipv6.conf.default.disable_ipv6 = 1',
-        'net.ipv6.conf.lo.disable_ipv6 = 1',
-    ]:
-        if not contains(c, '/etc/sysctl.conf', line):
-            append(c, '/etc/sysctl.conf', line)
-    c.sudo('sysctl -p')
+    _FACTS.pop(c.original_host, None)
 
 
 @task
@@ -124,68 +357,170 @@ def dotfiles(c: type[Connection]):
     """
     dotfiles
     """
-    c.run(
-        '[ ! -f ~/.tmux.conf ] && { '
-        'wget https://github.com/ichuan/dotfiles/releases/latest/download/dotfiles.'
-        'tar.gz -O - | tar xzf - && bash dotfiles/bootstrap.sh -f; }',
-        warn=True,
+    _ensure_open(c)
+    if not DRY_RUN:
+        try:
+            # sftp starts in $HOME
+            c.sftp().stat('.tmux.conf')
+            return
+        except FileNotFoundError:
+            pass
+    tarball = _cached_get(
+        'https://github.com/ichuan/dotfiles/releases/latest/download/dotfiles.tar.gz',
+        'dotfiles.tar.gz',
+    )
+    # into $HOME, not a shared /tmp another user could tamper with
+    _put(c, tarball, 'dotfiles.tar.gz')
+    _run(c, 'tar xzf dotfiles.tar.gz && bash dotfiles/bootstrap.sh -f', warn=True)
+    _run(
+        c,
+        'rm -rf dotfiles dotfiles.tar.gz ~/Tomorrow_Night_Bright.terminal '
+        '~/iTerm.profile.json',
     )
-    c.run('rm -rf dotfiles ~/Tomorrow_Night_Bright.terminal ~/iTerm.profile.json')
 
 
-@task
-def bbr(c: type[Connection]):
+def _bbr_sysctl(c: type[Connection]) -> dict[str, str]:
     """
-    Install Google BBR: https://github.com/google/bbr
+    Kernel parameters enabling bbr, empty if not needed or not supported
     """
-    if c.sudo(
-        'sysctl net.ipv4.tcp_available_congestion_control | grep -q bbr', warn=True
-    ).ok:
+    if 'bbr' in _facts(c)['congestion'].split():
         print('bbr already enabled')
-        return
-    kernel_version = c.run('uname -r', hide=True).stdout.strip()
-    if Version(kernel_version) < Version('4.9'):
+        return {}
+    if Version(_facts(c)['kernel']) < Version('4.9'):
         print('bbr need linux 4.9+, please upgrade your kernel')
-        return
-    for line in [
-        'net.core.default_qdisc = fq',
-        'net.ipv4.tcp_congestion_control = bbr',
-    ]:
-        if not contains(c, '/etc/sysctl.conf', line):
-            append(c, '/etc/sysctl.conf', line)
-    c.sudo('sysctl -p')
+        return {}
+    return {
+        'net.core.default_qdisc': 'fq',
+        'net.ipv4.tcp_congestion_control': 'bbr',
+    }
 
 
 @task
-def nodejs(c: type[Connection]):
+def bbr(c: type[Connection]):
+    """
+    Install Google BBR: https://github.com/google/bbr
+    """
+    _ensure_open(c)
+    _apply_sysctl(c, _bbr_sysctl(c))
+
+
+def _cached_get(url: str, name: str, ttl: int = 3600) -> str:
+    """
+    Download url into CACHE_DIR/name and return the local path. A copy younger
+    than ttl seconds is used as is, an older one is revalidated with
+    If-None-Match/If-Modified-Since. A dry run only prints url and returns it
+    """
+    if DRY_RUN:
+        print(f'[get] {url}')
+        return url
+    path = os.path.join(CACHE_DIR, name)
+    meta_path = f'{path}.meta'
+    headers = {}
+    if os.path.exists(path):
+        if time.time() - os.path.getmtime(path) < ttl:
+            return path
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as r:
+            data = r.read()
+            meta = {
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+            }
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        os.utime(path)
+        return path
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return path
+
+
+def _cached_json(url: str, name: str, ttl: int = 3600):
+    with open(_cached_get(url, name, ttl)) as f:
+        return json.load(f)
+
+
+def _node_lts(codename: str) -> tuple[str, str] | None:
+    """
+    (codename, version) of the latest Node.js of an LTS line, the newest LTS
+    line if codename is empty
+    """
+    version = ''
+    if codename:
+        # a small directory listing instead of the whole index.json
+        try:
+            listing = _cached_get(
+                NODE_LISTING_URL.format(codename), f'node-latest-{codename}.html'
+            )
+        except urllib.error.HTTPError as e:
+            print(f'Cannot fetch the listing of {codename}: {e}')
+        else:
+            with open(listing) as f:
+                m = re.search(r'node-(v[\d.]+)-linux-x64\.tar\.xz', f.read())
+            if m:
+                version = m.group(1)
+    if not version:
+        versions = _cached_json(NODE_INDEX_URL, 'node-index.json')
+        candidates = [
+            i
+            for i in versions
+            if i['lts'] and (not codename or i['lts'].lower() == codename)
+        ]
+        if not candidates:
+            print(f'No such LTS line: {codename}')
+            return None
+        lts = max(candidates, key=lambda i: Version(i['version']))
+        codename, version = lts['lts'].lower(), lts['version']
+    return codename, version
+
+
+@task(help={'codename': 'LTS line to install, e.g. jod. default: the latest LTS'})
+def nodejs(c: type[Connection], codename: str = ''):
     """
     Install latest Node.js
     """
-    versions = json.load(
-        urllib.request.urlopen(
-            # https://nodejs.org/dist/index.json
-            'https://registry.npmmirror.com/-/binary/node/index.json'
-        )
-    )
-    lts = sorted(
-        (i for i in versions if i['lts']), key=lambda i: Version(i['version'])
-    )[-1]
+    _ensure_open(c)
+    codename = codename.lower()
+    if DRY_RUN:
+        # no version lookup, only the shape of the download
+        url = NODE_LISTING_URL.format(codename) if codename else NODE_INDEX_URL
+        print(f'[get] {url}')
+        version = '<version>'
+    elif lts := _node_lts(codename):
+        _, version = lts
+    else:
+        return
     # already has?
-    if c.run(f'which node && test `node --version` = "{lts["version"]}"', warn=True).ok:
+    if _facts(c)['node'] == version:
         print('Already installed nodejs')
         return
-    dist_url = f'https://nodejs.org/dist/latest-{lts['lts'].lower()}/node-{lts['version']}-linux-x64.tar.xz'
-    c.run(f'wget -O /tmp/node.tar.xz --tries 3 {dist_url}')
-    c.sudo(
-        'tar -C /usr/ --exclude CHANGELOG.md --exclude LICENSE '
-        '--exclude README.md --strip-components 1 -xf /tmp/node.tar.xz'
+    # versioned path, latest-<codename>/ drops a release as soon as the next ships
+    dist_url = f'https://nodejs.org/dist/{version}/node-{version}-linux-x64.tar.xz'
+    # stream straight into tar, no temp file
+    _run(
+        c,
+        f'set -o pipefail; wget -O - --tries 3 {dist_url} | sudo tar -C /usr/ '
+        '--exclude CHANGELOG.md --exclude LICENSE --exclude README.md '
+        '--strip-components 1 -xJf -',
     )
+    _FACTS.pop(c.original_host, None)
     # can listening on 80 and 443
     # c.sudo('setcap cap_net_bind_service=+ep /usr/bin/node')
 
 
 def _get_output(c: type[Connection], cmd: str) -> str:
-    result = c.run(cmd, hide=True)
+    result = _run(c, cmd, hide=True)
     return result.stdout.strip()
 
 
@@ -194,38 +529,47 @@ def docker(c: type[Connection]):
     """
     Install docker and docker-compose on debian/ubuntu
     """
+    _ensure_open(c)
     # https://docs.docker.com/engine/install/debian/
-    if c.run('which docker', warn=True).ok:
+    if _facts(c)['docker']:
         print('Already installed docker')
         return
-    c.sudo('apt update -yq')
-    c.sudo('apt install -yq apt-transport-https ca-certificates curl')
-    c.sudo('install -m 0755 -d /etc/apt/keyrings')
-    c.sudo(
+    codename = _facts(c)['codename']
+    if not codename:
+        print('Cannot tell the debian codename (VERSION_CODENAME in /etc/os-release)')
+        return
+    # curl comes with debian(), ca-certificates is installed with docker below
+    _sudo(c, 'install -m 0755 -d /etc/apt/keyrings')
+    _sudo(
+        c,
         'curl -fsSL https://download.docker.com/linux/debian/gpg '
-        '-o /etc/apt/keyrings/docker.asc'
+        '-o /etc/apt/keyrings/docker.asc',
     )
-    c.sudo('chmod a+r /etc/apt/keyrings/docker.asc')
-    codename = _get_output(c, 'lsb_release -sc')
-    c.run(
+    _sudo(c, 'chmod a+r /etc/apt/keyrings/docker.asc')
+    _run(
+        c,
         'echo "deb [arch=amd64 signed-by=/etc/apt/keyrings/docker.asc] '
         f'https://download.docker.com/linux/debian {codename} stable" '
-        '| sudo tee /etc/apt/sources.list.d/docker.list'
+        '| sudo tee /etc/apt/sources.list.d/docker.list',
     )
-    c.sudo('apt update -yq')
-    c.sudo(
-        'apt install -yq docker-ce docker-ce-cli containerd.io docker-compose-plugin'
+    _sudo(c, 'apt-get update -yq')
+    _sudo(
+        c,
+        'apt-get install -yq ca-certificates docker-ce docker-ce-cli containerd.io '
+        'docker-buildx-plugin docker-compose-plugin',
     )
     # docker logging rotate
-    c.run(
+    _run(
+        c,
         r"""echo -e '{\n  "log-driver": "json-file",\n  "log-opts": """
         r"""{\n    "max-size": "100m",\n    "max-file": "5"\n  }\n}' """
-        r"""| sudo tee /etc/docker/daemon.json"""
+        r"""| sudo tee /etc/docker/daemon.json""",
     )
-    c.sudo('service docker restart', warn=True)
+    _sudo(c, 'service docker restart', warn=True)
     # fix permission issue
-    if c.run('test $USER = root', warn=True).failed:
-        c.run('sudo usermod -a -G docker $USER', warn=True)
+    if _facts(c)['uid'] != '0':
+        _run(c, 'sudo usermod -a -G docker $USER', warn=True)
+    _FACTS.pop(c.original_host, None)
 
 
 @task(help={'gb': 'Size of the swapfile (GB)'})
@@ -233,19 +577,17 @@ def swap(c: type[Connection], gb: int = 1):
     """
     Install a swapfile, default to 1GB
     """
+    _ensure_open(c)
     path = f'/swap{gb}G'
-    if c.run(f'test -f {path}', warn=True).ok:
+    if _run(c, f'test -f {path}', warn=True).ok:
         print(f'{path} already exists')
         return
-    c.sudo(f'fallocate -l {gb}G {path}')
-    c.sudo(f'chmod 600 {path}')
-    c.sudo(f'mkswap {path}')
-    c.sudo(f'swapon {path}')
-    if not contains(c, '/etc/sysctl.conf', 'vm.swappiness=10'):
-        append(c, '/etc/sysctl.conf', 'vm.swappiness=10')
-    line = f'{path} none swap sw 00'
-    if not contains(c, '/etc/fstab', line):
-        append(c, '/etc/fstab', line)
+    _sudo(c, f'fallocate -l {gb}G {path}')
+    _sudo(c, f'chmod 600 {path}')
+    _sudo(c, f'mkswap {path}')
+    _sudo(c, f'swapon {path}')
+    _apply_sysctl(c, {'vm.swappiness': '10'})
+    _ensure_lines(c, '/etc/fstab', [f'{path} none swap sw 00'])
 
 
 @task(help={'version': 'which latest version to install. default: 3'})
@@ -253,26 +595,30 @@ def python(c: type[Connection], version: str = '3'):
     """
     Install pyenv, latest python3 and poetry
     """
+    _ensure_open(c)
     # Prerequisites: git, dotfiles (in debian)
-    if not exists(c, '~/.pyenv'):
-        c.run('curl https://pyenv.run | bash')
-        c.sudo('apt update -yq')
-        c.sudo(
-            'apt install -y build-essential checkinstall libncursesw5-dev libssl-dev '
-            'libsqlite3-dev tk-dev libgdbm-dev libc6-dev libbz2-dev libffi-dev '
-            'libreadline-dev liblzma-dev zlib1g-dev'
-        )
-        if c.run('test -f ~/.bash_profile && grep -q pyenv ~/.bash_profile').ok:
+    if not _facts(c)['pyenv']:
+        # pyenv alone, shallow, and still updatable with git pull
+        _run(c, 'git clone -q --depth 1 https://github.com/pyenv/pyenv.git ~/.pyenv')
+        _script(c, _apt_install_sh(PYTHON_BUILD_PACKAGES))
+        if _run(c, 'grep -qs pyenv ~/.bash_profile', warn=True).ok:
             pass
         else:
-            c.run(
+            _run(
+                c,
                 r'echo -e "export PYENV_ROOT=\"\$HOME/.pyenv\"\n'
                 r'export PATH=\"\$PYENV_ROOT/bin:\$PATH\"\n'
                 r'command -v pyenv > /dev/null && eval \"\$(pyenv init --path)\"" '
-                r'>> ~/.bash_profile'
+                r'>> ~/.bash_profile',
             )
-    c.run(f'source ~/.bash_profile && pyenv install {version}:latest', warn=True)
-    _poetry(c)
+    else:
+        # a newer python only shows up in a newer pyenv
+        _run(c, 'git -C ~/.pyenv pull -q --ff-only', warn=True)
+    # -s: no-op if the latest one is installed already
+    _run(c, f'source ~/.bash_profile && pyenv install -s {version}:latest', warn=True)
+    if not _facts(c)['poetry']:
+        _poetry(c)
+    _FACTS.pop(c.original_host, None)
 
 
 def _poetry(c: type[Connection]):
@@ -284,13 +630,18 @@ def _poetry(c: type[Connection]):
         export PATH="$HOME/.pyenv/bin:$PATH"
         export PYENV_VERSION=`pyenv versions --bare --skip-aliases|sort -V | tail -n 1`
         curl -sSL https://install.python-poetry.org | pyenv exec python -
-        # bin
-        echo "export PATH=\"\$HOME/.local/bin:\$PATH\"" >> ~/.bash_profile
-        echo "export POETRY_VIRTUALENVS_IN_PROJECT=true" >> ~/.bash_profile
-        echo "export POETRY_VIRTUALENVS_PREFER_ACTIVE_PYTHON=true" >> ~/.bash_profile
+        # bin, only once
+        if ! grep -qs POETRY_VIRTUALENVS_IN_PROJECT ~/.bash_profile; then
+            cat >> ~/.bash_profile <<'EOF'
+        export PATH="$HOME/.local/bin:$PATH"
+        export POETRY_VIRTUALENVS_IN_PROJECT=true
+        export POETRY_VIRTUALENVS_PREFER_ACTIVE_PYTHON=true
+        EOF
+        fi
         """
     )
-    c.run(_sh)
+    # over stdin, no script file left behind in a shared /tmp
+    _script(c, _sh, sudo=False)
 
 
 @task(
@@ -303,34 +654,38 @@ def trojan(c: type[Connection], domain: str, password: str = ''):
     """
     Install a trojan proxy (requires docker and a domain name)
     """
+    _ensure_open(c)
     if not domain:
         print('domain needed')
         return
     path = '$HOME/trojan'
-    if exists(c, path):
+    if _exists(c, path):
         print('trojan already installed')
         return
     if not password:
         password = os.urandom(16).hex()
         print(f'Generated password: {password}')
-    c.run(f'mkdir -p {path} {path}/acme.sh', warn=True)
-    c.run(
+    _run(c, f'mkdir -p {path} {path}/acme.sh', warn=True)
+    _run(
+        c,
         'docker volume create --driver local --opt type=none '
-        f'--opt device={path}/acme.sh --opt o=bind acme.sh'
+        f'--opt device={path}/acme.sh --opt o=bind acme.sh',
     )
     # fetching SSL certs
-    c.run(
+    _run(
+        c,
         'docker run -i --rm --name acme.sh -p 80:80 -v acme.sh:/root/.acme.sh '
         '--entrypoint bash ghcr.io/ichuan/trojan-docker -c '
         '"/etc/init.d/nginx start ; /root/.acme.sh/acme.sh --home /root/.acme.sh '
-        f'--issue --server letsencrypt -d {domain} -w /var/www/html"'
+        f'--issue --server letsencrypt -d {domain} -w /var/www/html"',
     )
     # start
-    c.run(
+    _run(
+        c,
         r"echo -e '#!/bin/bash\ndocker run --restart always -id --name trojan "
         r'-p 443:443 -p 80:80 -v acme.sh:/root/.acme.sh -e '
         rf'DOMAIN="{domain}" -e PASSWORD="{password}" '
-        rf"ghcr.io/ichuan/trojan-docker' > {path}/start.sh"
+        rf"ghcr.io/ichuan/trojan-docker' > {path}/start.sh",
     )
-    c.run(f'chmod +x {path}/start.sh && {path}/start.sh')
+    _run(c, f'chmod +x {path}/start.sh && {path}/start.sh')
     print(f'Done. Remember the password: {password}')